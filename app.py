@@ -1,12 +1,26 @@
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import random
 import re
-from flask import Flask, render_template_string, request, jsonify
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from flask import Flask, Response, render_template_string, request, jsonify, g, has_request_context, send_file
 from dotenv import load_dotenv
 from openai import OpenAI
 import pinecone
+from export import (EXPORT_FORMATS, ZipStream, cached_export_path, export_filename, invalid_export_fields,
+                    prune_export_cache, render_to_cache, touch_cached_export)
 
 # Load environment variables
 load_dotenv()
@@ -18,18 +32,158 @@ logger = logging.getLogger(__name__)
 # Initialize Flask app
 app = Flask(__name__)
 
-# Initialize services
-openai_client = OpenAI()
-
-# Initialize Pinecone
+# Services and local state, set up by init_services()
+openai_client = None
 pinecone_index = None
-try:
-    pinecone.init(api_key=os.getenv("PINECONE_API_KEY"), environment=os.getenv("PINECONE_ENVIRONMENT", "us-east-1-aws"))
-    pinecone_index = pinecone.Index("aog-devo")
-    logger.info("✅ Pinecone initialized successfully")
-except Exception as e:
-    logger.warning(f"⚠️ Pinecone initialization failed: {e}. Will use fallback content.")
+chunk_graph = None
+capture_logger = None
+
+# Chunk neighbor/section graph written by the ingestion notebook (devo.ipynb)
+CHUNK_GRAPH_PATH = os.getenv("CHUNK_GRAPH_PATH", "chunk_graph.json")
+
+def load_chunk_graph(path):
+    """Load the chunk -> prev/next/section graph persisted at ingestion time"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            graph = json.load(f)
+        logger.info(f"✅ Loaded chunk graph with {len(graph['chunks'])} chunks and {len(graph['sections'])} sections")
+        return graph
+    except FileNotFoundError:
+        logger.info(f"No chunk graph at {path}. Retrieval will use raw chunks.")
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"⚠️ Chunk graph at {path} is invalid: {e}. Retrieval will use raw chunks.")
+    return None
+
+# Character budget for retrieved context; roughly the three raw chunks retrieval used to return
+CONTEXT_MAX_CHARS = int(os.getenv("CONTEXT_MAX_CHARS", 8000))
+
+# Opt-in traffic capture for replay.py; set CAPTURE_DIR to enable
+CAPTURE_DIR = os.getenv("CAPTURE_DIR")
+
+def init_capture_logger(capture_dir):
+    """Set up a rotating JSONL logger for captured /generate requests"""
+    if not capture_dir:
+        return None
+    try:
+        os.makedirs(capture_dir, exist_ok=True)
+        handler = RotatingFileHandler(
+            os.path.join(capture_dir, "captures.jsonl"),
+            maxBytes=int(os.getenv("CAPTURE_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(os.getenv("CAPTURE_BACKUP_COUNT", 5)),
+            encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        capture = logging.getLogger("aog_devo.capture")
+        capture.setLevel(logging.INFO)
+        capture.propagate = False
+        capture.addHandler(handler)
+        logger.info(f"✅ Capturing /generate traffic to {capture_dir}")
+        return capture
+    except Exception as e:
+        logger.warning(f"⚠️ Traffic capture disabled: {e}")
+        return None
+
+def init_services():
+    """Create the API clients and load the local state used to serve requests"""
+    global openai_client, pinecone_index, chunk_graph, capture_logger
+    
+    # Initialize services
+    openai_client = OpenAI()
+    
+    # Initialize Pinecone
     pinecone_index = None
+    try:
+        pinecone.init(api_key=os.getenv("PINECONE_API_KEY"), environment=os.getenv("PINECONE_ENVIRONMENT", "us-east-1-aws"))
+        pinecone_index = pinecone.Index("aog-devo")
+        logger.info("✅ Pinecone initialized successfully")
+    except Exception as e:
+        logger.warning(f"⚠️ Pinecone initialization failed: {e}. Will use fallback content.")
+        pinecone_index = None
+    
+    chunk_graph = load_chunk_graph(CHUNK_GRAPH_PATH)
+    capture_logger = init_capture_logger(CAPTURE_DIR)
+
+# Export workers (see get_export_pool) re-run the main script as __mp_main__
+# when app.py is started directly; they only render, so skip the clients,
+# credentials, chunk graph and capture handler there
+if __name__ != '__mp_main__':
+    init_services()
+
+# Patterns redacted from prompts before they are written to a capture
+CAPTURE_REDACTIONS = [
+    (re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+'), '[email]'),
+    (re.compile(r'(?<!\d)(?:\+?1[\s.-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}(?!\d)'), '[phone]')
+]
+
+def sanitize_for_capture(text):
+    """Redact personal details (emails, phone numbers) from captured text.
+
+    Only phone-number shapes are redacted, so replay re-sends year and verse
+    ranges exactly as production received them:
+
+    >>> sanitize_for_capture("Call (555) 123-4567 or +1 555.123.4567, mail a.b@x.org")
+    'Call [phone] or [phone], mail [email]'
+    >>> sanitize_for_capture("faith for 2024-2025 school year using John 3:16-17 and Psalm 119:105-112")
+    'faith for 2024-2025 school year using John 3:16-17 and Psalm 119:105-112'
+    """
+    for pattern, replacement in CAPTURE_REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+@contextmanager
+def capture_stage(stage):
+    """Time a stage and record it on the current capture, including failures.
+
+    Yields a dict for the stage's details (e.g. the upstream response). If the
+    stage raises, its elapsed time and error are still recorded so replay can
+    reproduce slow or failing upstreams.
+    """
+    details = {}
+    started = time.perf_counter()
+    try:
+        yield details
+    except Exception as e:
+        details['error'] = str(e)
+        raise
+    finally:
+        if has_request_context() and 'capture' in g:
+            g.capture['stages'][stage] = {
+                'ms': round((time.perf_counter() - started) * 1000, 2),
+                **details
+            }
+
+# Devotional export (DOCX/PDF); rendered files are cached by content hash
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aog-devo-exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+EXPORT_MAX_DEVOTIONALS = int(os.getenv("EXPORT_MAX_DEVOTIONALS", 104))
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+export_pool = None
+export_pool_lock = threading.Lock()
+
+def get_export_pool():
+    """Lazily start the process pool that renders exports; None if unavailable.
+
+    Workers come from a fork server (spawn where that's unavailable) rather
+    than forking this multithreaded server, which can deadlock on inherited locks.
+    """
+    global export_pool
+    with export_pool_lock:
+        if export_pool is None:
+            try:
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload(["export"])
+                else:
+                    context = multiprocessing.get_context("spawn")
+                export_pool = ProcessPoolExecutor(
+                    max_workers=int(os.getenv("EXPORT_WORKERS", os.cpu_count() or 1)),
+                    mp_context=context
+                )
+            except (OSError, NotImplementedError, ImportError) as e:
+                logger.warning(f"⚠️ Export process pool unavailable: {e}. Rendering in-process.")
+                export_pool = False
+    return export_pool or None
 
 # Bible verses for random selection when none provided
 RANDOM_BIBLE_VERSES = [
@@ -103,6 +257,44 @@ def detect_age_group(text):
     
     return "adults"  # Default to adults if no specific age group detected
 
+def chunk_text_hash(text):
+    """Short content hash matching the text_hash stored per chunk by devo.ipynb"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def expand_matches_to_sections(matches, max_chars=CONTEXT_MAX_CHARS):
+    """Expand Pinecone matches to the whole devotional sections they overlap.
+
+    Hits are taken best score first and each hit's sections are added as a
+    unit, so a hit is either fully included or skipped once max_chars is used
+    (the best hit is always included). Sections shared with a higher-scoring
+    hit are not repeated.
+    """
+    seen = set()
+    relevant_content = []
+    used_chars = 0
+    for match in sorted(matches, key=lambda m: m.score or 0, reverse=True):
+        text = match.metadata.get('text') if match.metadata else None
+        node = chunk_graph['chunks'].get(match.id) if chunk_graph else None
+        if node and node['sections'] and (text is None or node.get('text_hash') == chunk_text_hash(text)):
+            keys = [(section_id, chunk_graph['sections'][section_id]['text']) for section_id in node['sections']]
+        elif text:
+            # Chunk missing from the graph, or the graph predates the last ingestion; use its own text
+            keys = [(f"chunk:{match.id}", text)]
+        else:
+            continue
+
+        new_keys = [(key, section_text) for key, section_text in keys if key not in seen]
+        hit_chars = sum(len(section_text) for _, section_text in new_keys)
+        if relevant_content and used_chars + hit_chars > max_chars:
+            continue
+
+        for key, section_text in new_keys:
+            seen.add(key)
+            relevant_content.append(section_text)
+        used_chars += hit_chars
+
+    return relevant_content
+
 def get_relevant_content_from_pinecone(query, top_k=3):
     """Retrieve relevant content from Pinecone index"""
     # Check if Pinecone is available
@@ -119,25 +311,29 @@ def get_relevant_content_from_pinecone(query, top_k=3):
     
     try:
         # Create embedding for the query
-        query_response = openai_client.embeddings.create(
-            input=query,
-            model="text-embedding-3-large"
-        )
-        query_embedding = query_response.data[0].embedding
+        with capture_stage('embedding') as stage:
+            query_response = openai_client.embeddings.create(
+                input=query,
+                model="text-embedding-3-large"
+            )
+            query_embedding = query_response.data[0].embedding
+            stage['dimensions'] = len(query_embedding)
         
         # Search Pinecone for similar content
-        search_response = pinecone_index.query(
-            vector=query_embedding,
-            top_k=top_k,
-            include_metadata=True,
-            include_values=False
-        )
+        with capture_stage('pinecone_query') as stage:
+            search_response = pinecone_index.query(
+                vector=query_embedding,
+                top_k=top_k,
+                include_metadata=True,
+                include_values=False
+            )
+            stage['matches'] = [
+                {'id': match.id, 'score': match.score, 'metadata': dict(match.metadata or {})}
+                for match in search_response.matches
+            ]
         
-        # Extract content from matches
-        relevant_content = []
-        for match in search_response.matches:
-            if match.metadata and 'text' in match.metadata:
-                relevant_content.append(match.metadata['text'])
+        # Expand matches to whole sections so context doesn't stop mid-section
+        relevant_content = expand_matches_to_sections(search_response.matches)
         
         if relevant_content:
             return '\n\n'.join(relevant_content)
@@ -163,17 +359,21 @@ def get_relevant_content_from_pinecone(query, top_k=3):
 def generate_devotional(user_prompt):
     """Generate a devotional based on user prompt"""
     try:
-        # Extract scripture reference from prompt
-        scripture_ref = extract_scripture_reference(user_prompt)
-        
-        # If no scripture found, use a random one
-        if not scripture_ref:
-            random_verse = random.choice(RANDOM_BIBLE_VERSES)
-            scripture_ref = random_verse["reference"]
-        
-        # Detect age group from prompt
-        age_group = detect_age_group(user_prompt)
-        age_config = AGE_GROUP_PROMPTS[age_group]
+        with capture_stage('parse') as stage:
+            # Extract scripture reference from prompt
+            scripture_ref = extract_scripture_reference(user_prompt)
+            random_scripture = scripture_ref is None
+            
+            # If no scripture found, use a random one
+            if not scripture_ref:
+                random_verse = random.choice(RANDOM_BIBLE_VERSES)
+                scripture_ref = random_verse["reference"]
+            
+            # Detect age group from prompt
+            age_group = detect_age_group(user_prompt)
+            age_config = AGE_GROUP_PROMPTS[age_group]
+            stage.update(scripture_reference=scripture_ref,
+                         random_scripture=random_scripture, age_group=age_group)
         
         # Get relevant content from Pinecone
         search_query = f"{user_prompt} {scripture_ref}"
@@ -220,18 +420,20 @@ def generate_devotional(user_prompt):
         }}
         """
         
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a Christian devotional writer specializing in age-appropriate spiritual content using Assemblies of God format."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1000
-        )
-        
-        # Parse the JSON response
-        content = response.choices[0].message.content.strip()
+        with capture_stage('completion') as stage:
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "You are a Christian devotional writer specializing in age-appropriate spiritual content using Assemblies of God format."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.7,
+                max_tokens=1000
+            )
+            
+            # Parse the JSON response
+            content = response.choices[0].message.content.strip()
+            stage['content'] = content
         
         # Extract JSON from the response
         try:
@@ -259,6 +461,60 @@ def generate_devotional(user_prompt):
         logger.error(f"Error generating devotional: {str(e)}")
         raise e
 
+def render_exports(devotionals, fmt):
+    """Render cache misses across the process pool and return file paths in order.
+
+    Everything is rendered before returning, so a rendering or worker error
+    surfaces before a response is started rather than partway through a stream.
+    """
+    global export_pool
+    pool = get_export_pool()
+    pending = []
+    for devotional in devotionals:
+        path = cached_export_path(devotional, fmt, EXPORT_CACHE_DIR)
+        if touch_cached_export(path):
+            pending.append(path)
+        elif pool:
+            pending.append(pool.submit(render_to_cache, devotional, fmt, EXPORT_CACHE_DIR))
+        else:
+            pending.append(None)
+
+    paths = []
+    for devotional, item in zip(devotionals, pending):
+        if isinstance(item, str):
+            paths.append(item)
+        elif item is None:
+            paths.append(render_to_cache(devotional, fmt, EXPORT_CACHE_DIR))
+        else:
+            try:
+                paths.append(item.result())
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool on the next export
+                with export_pool_lock:
+                    if export_pool is pool:
+                        export_pool = None
+                raise
+
+    if any(not isinstance(item, str) for item in pending):
+        prune_export_cache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES)
+    return paths
+
+def stream_export_zip(devotionals, paths, fmt):
+    """Stream rendered devotionals as a ZIP archive without holding it in memory"""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for index, (devotional, path) in enumerate(zip(devotionals, paths), 1):
+            with open(path, 'rb') as src, archive.open(export_filename(devotional, fmt, index), 'w') as dest:
+                while True:
+                    chunk = src.read(EXPORT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+    yield stream.drain()
+
 # HTML template
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -631,7 +887,46 @@ HTML_TEMPLATE = '''
             errorDiv.scrollIntoView({ behavior: 'smooth' });
         }
         
+        let currentDevotional = null;
+        
+        async function downloadDevotional(format) {
+            try {
+                const response = await fetch('/export', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({ devotional: currentDevotional, format: format })
+                });
+                
+                if (!response.ok) {
+                    const data = await response.json();
+                    showError(data.error || 'An error occurred. Please try again.');
+                    return;
+                }
+                
+                // Use the title-based filename the server sends
+                const disposition = response.headers.get('Content-Disposition') || '';
+                const encodedName = disposition.match(/filename[*]=UTF-8''([^;]+)/i);
+                const plainName = disposition.match(/filename="?([^";]+)"?/i);
+                const filename = encodedName ? decodeURIComponent(encodedName[1])
+                    : plainName ? plainName[1] : `devotional.${format}`;
+                
+                const url = URL.createObjectURL(await response.blob());
+                const link = document.createElement('a');
+                link.href = url;
+                link.download = filename;
+                link.click();
+                URL.revokeObjectURL(url);
+                
+            } catch (error) {
+                console.error('Error:', error);
+                showError('Network error. Please check your connection and try again.');
+            }
+        }
+        
         function displayDevotional(devotional) {
+            currentDevotional = devotional;
             const resultDiv = document.getElementById('result');
             
             const ageGroupMap = {
@@ -674,6 +969,8 @@ HTML_TEMPLATE = '''
                 
                 <div class="actions">
                     <button type="button" onclick="window.print()">Print Devotional</button>
+                    <button type="button" onclick="downloadDevotional('docx')">Download DOCX</button>
+                    <button type="button" onclick="downloadDevotional('pdf')">Download PDF</button>
                     <button type="button" onclick="document.getElementById('devotionalForm').reset(); document.getElementById('result').style.display='none'; document.getElementById('prompt').focus();">Create Another</button>
                 </div>
             `;
@@ -698,6 +995,15 @@ def generate():
         data = request.get_json()
         prompt = data.get('prompt', '').strip()
         
+        if capture_logger:
+            g.capture = {
+                'id': uuid.uuid4().hex,
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'prompt': sanitize_for_capture(prompt),
+                'stages': {}
+            }
+            g.capture_started = time.perf_counter()
+        
         if not prompt:
             return jsonify({'error': 'Please provide a devotional request.'}), 400
         
@@ -713,6 +1019,60 @@ def generate():
         logger.error(f"Error in /generate endpoint: {str(e)}")
         return jsonify({'error': 'Sorry, there was an error generating your devotional. Please try again.'}), 500
 
+@app.route('/export', methods=['POST'])
+def export_devotionals():
+    """Export one devotional as DOCX/PDF, or many as a streamed ZIP"""
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Please provide the devotional(s) to export.'}), 400
+        
+        fmt = data.get('format', 'docx')
+        devotionals = data.get('devotionals') or ([data['devotional']] if data.get('devotional') else [])
+        
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'error': f"Unsupported export format. Choose one of: {', '.join(EXPORT_FORMATS)}."}), 400
+        
+        if not isinstance(devotionals, list) or not devotionals or not all(isinstance(d, dict) for d in devotionals):
+            return jsonify({'error': 'Please provide the devotional(s) to export.'}), 400
+        
+        if len(devotionals) > EXPORT_MAX_DEVOTIONALS:
+            return jsonify({'error': f'Please export at most {EXPORT_MAX_DEVOTIONALS} devotionals at a time.'}), 400
+        
+        for position, devotional in enumerate(devotionals, 1):
+            invalid = invalid_export_fields(devotional)
+            if invalid:
+                return jsonify({'error': f"Devotional {position} has invalid {', '.join(invalid)}: expected text."}), 400
+        
+        paths = render_exports(devotionals, fmt)
+        
+        if len(devotionals) == 1:
+            return send_file(paths[0], mimetype=EXPORT_FORMATS[fmt], as_attachment=True,
+                             download_name=export_filename(devotionals[0], fmt))
+        
+        return Response(
+            stream_export_zip(devotionals, paths, fmt),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="devotionals-{fmt}.zip"'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in /export endpoint: {str(e)}")
+        return jsonify({'error': 'Sorry, there was an error exporting your devotional. Please try again.'}), 500
+
+@app.after_request
+def write_capture(response):
+    """Append the finished request's capture record, if any"""
+    if 'capture' in g:
+        try:
+            g.capture['status'] = response.status_code
+            g.capture['total_ms'] = round((time.perf_counter() - g.capture_started) * 1000, 2)
+            g.capture['response'] = response.get_json(silent=True)
+            capture_logger.info(json.dumps(g.capture, ensure_ascii=False))
+        except Exception as e:
+            logger.error(f"Error writing capture record: {str(e)}")
+    return response
+
 # For Vercel deployment - expose the Flask app
 # Vercel will automatically detect this as the WSGI application
 application = app
@@ -0,0 +1,194 @@
+"""Render devotionals to DOCX/PDF in the AOG Family Devotions layout.
+
+Kept separate from app.py so rendering has no dependency on the OpenAI or
+Pinecone clients. app.py runs it in worker processes started by a fork
+server that preloads only this module. When app.py is started directly,
+multiprocessing also re-runs it in each worker as __mp_main__; app.py skips
+its client, chunk graph and capture setup there.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+from docx import Document
+from docx.shared import Pt
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
+
+EXPORT_FORMATS = {
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pdf": "application/pdf"
+}
+
+# Bump when the rendered layout changes so cached files are re-rendered
+LAYOUT_VERSION = 1
+
+# (heading, devotional field) pairs in the official section order
+SECTIONS = [
+    ("LISTEN to God through His Word", "listen_content"),
+    ("LEARN from God’s Word", "learn_content"),
+    ("LIVE God’s Word", "live_content"),
+    ("PRAY about It", "prayer")
+]
+
+# Devotional fields rendered into the document; each must be a string or null if present
+EXPORT_TEXT_FIELDS = ["title", "question_of_day"] + [field for _, field in SECTIONS]
+
+# Cached files used more recently than this are never pruned, so exports in
+# flight can still open them; leftover .tmp files older than this are removed
+EXPORT_CACHE_MIN_AGE = 10 * 60
+
+
+def invalid_export_fields(devotional):
+    """Names of rendered fields that are present but not strings (null counts as absent)"""
+    return [field for field in EXPORT_TEXT_FIELDS
+            if devotional.get(field) is not None and not isinstance(devotional[field], str)]
+
+
+def export_key(devotional, fmt):
+    """Content hash identifying a rendered devotional in the export cache"""
+    payload = json.dumps({"layout": LAYOUT_VERSION, "format": fmt, "devotional": devotional},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def export_filename(devotional, fmt, index=None):
+    """Download filename for a devotional, optionally prefixed with its position"""
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', devotional.get("title") or "devotional").strip('-').lower()
+    prefix = f"{index:03d}-" if index is not None else ""
+    return f"{prefix}{slug or 'devotional'}.{fmt}"
+
+
+def content_lines(text):
+    """Non-blank lines of a devotional section"""
+    return [line.strip() for line in (text or "").split("\n") if line.strip()]
+
+
+def render_docx(devotional, fp):
+    """Write a devotional as DOCX to a binary file object"""
+    document = Document()
+    document.add_heading(devotional.get("title") or "FAMILY DEVOTIONS", level=1)
+
+    question = document.add_paragraph().add_run(devotional.get("question_of_day") or "")
+    question.bold = True
+    question.font.size = Pt(14)
+
+    for heading, field in SECTIONS:
+        document.add_heading(heading, level=2)
+        for line in content_lines(devotional.get(field)):
+            document.add_paragraph().add_run(line).bold = line == "Question"
+
+    document.save(fp)
+
+
+def render_pdf(devotional, fp):
+    """Write a devotional as PDF to a binary file object"""
+    styles = getSampleStyleSheet()
+    story = [
+        Paragraph(escape(devotional.get("title") or "FAMILY DEVOTIONS"), styles["Title"]),
+        Paragraph(f"<b>{escape(devotional.get('question_of_day') or '')}</b>", styles["Heading3"])
+    ]
+
+    for heading, field in SECTIONS:
+        story.append(Paragraph(escape(heading), styles["Heading2"]))
+        for line in content_lines(devotional.get(field)):
+            text = f"<b>{escape(line)}</b>" if line == "Question" else escape(line)
+            story.append(Paragraph(text, styles["BodyText"]))
+        story.append(Spacer(1, 6))
+
+    SimpleDocTemplate(fp, pagesize=letter, title=devotional.get("title") or "").build(story)
+
+
+RENDERERS = {"docx": render_docx, "pdf": render_pdf}
+
+
+def cached_export_path(devotional, fmt, cache_dir):
+    """Path a devotional's rendered file is (or will be) cached at"""
+    return os.path.join(cache_dir, f"{export_key(devotional, fmt)}.{fmt}")
+
+
+def touch_cached_export(path):
+    """Mark a cached export as recently used; False if it isn't cached"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def render_to_cache(devotional, fmt, cache_dir):
+    """Render a devotional into the export cache and return the cached file path.
+
+    Runs in export worker processes. Files are written to a temporary name
+    and renamed into place so concurrent renders of the same content are safe.
+    """
+    path = cached_export_path(devotional, fmt, cache_dir)
+    if touch_cached_export(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=f".{fmt}.tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            RENDERERS[fmt](devotional, fp)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def prune_export_cache(cache_dir, max_bytes, min_age=EXPORT_CACHE_MIN_AGE):
+    """Delete least recently used exports until the cache fits in max_bytes.
+
+    Cache hits refresh a file's mtime, so oldest mtime is least recently used.
+    """
+    entries = []
+    try:
+        with os.scandir(cache_dir) as scan:
+            for entry in scan:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - min_age
+    for mtime, size, path in sorted(entries):
+        if mtime > cutoff:
+            break
+        if path.endswith(".tmp") or total > max_bytes:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile that hands written bytes back in chunks"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Return and forget everything written since the last drain"""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
@@ -0,0 +1,220 @@
+"""Replay captured /generate traffic against the current app.py.
+
+Captures are written by app.py when CAPTURE_DIR is set. Each record is
+re-sent through the Flask app in-process, on the original arrival schedule
+(optionally sped up), with OpenAI and Pinecone replaced by stubs that return
+either the recorded upstream responses or canned ones.
+
+    python replay.py captures/captures.jsonl --speed 10 --out results.jsonl
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+# app.py builds an OpenAI client at import time; the stubs never use the key
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+# Don't capture replayed traffic, possibly into the very file being replayed.
+# Set rather than removed so load_dotenv() in app.py can't re-enable it from .env.
+os.environ["CAPTURE_DIR"] = ""
+
+import app as devo_app
+
+# Capture record being replayed by the current worker thread
+_current = threading.local()
+
+STUB_COMPLETION = json.dumps({
+    "title": "Day 1—FAMILY DEVOTIONS",
+    "question_of_day": "Question of the Day: How can we grow closer to God today?",
+    "listen_scripture": "John 3:16",
+    "listen_content": "Pray and ask God to speak to you before you read today's Scripture.\n\nRead John 3:16.",
+    "learn_content": "Question\nWhat does this verse teach us about God?\nAnswer: God loves us.",
+    "live_content": "Question\nHow can you share God's love today?\nAnswer: Answers will vary.",
+    "prayer": "Dear God, thank You for loving us. I love You, God. Amen.",
+    "age_group": "adults",
+    "scripture_reference": "John 3:16"
+})
+
+
+def load_captures(paths):
+    """Load capture records from JSONL files (rotated backups included), oldest first"""
+    records = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["timestamp"])
+    return records
+
+
+class RecordedUpstreamError(Exception):
+    """An upstream call that failed when the request was captured"""
+
+
+def recorded_stage(stage):
+    """Return the current record's capture for a stage, sleeping for its recorded latency.
+
+    With recorded upstreams, a stage captured with an error raises it again
+    after the recorded latency, as the real upstream did.
+    """
+    details = _current.record.get("stages", {}).get(stage, {})
+    if _current.upstream == "recorded":
+        if _current.latency:
+            time.sleep(details.get("ms", 0) / 1000)
+        if "error" in details:
+            raise RecordedUpstreamError(details["error"])
+    return details
+
+
+class StubEmbeddings:
+    def create(self, input, model):
+        details = recorded_stage("embedding")
+        dimensions = details.get("dimensions", 3072)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.0] * dimensions)])
+
+
+class StubCompletions:
+    def create(self, **kwargs):
+        details = recorded_stage("completion")
+        content = details["content"] if _current.upstream == "recorded" and "content" in details else STUB_COMPLETION
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class StubOpenAI:
+    def __init__(self):
+        self.embeddings = StubEmbeddings()
+        self.chat = SimpleNamespace(completions=StubCompletions())
+
+
+class StubIndex:
+    def query(self, **kwargs):
+        details = recorded_stage("pinecone_query")
+        matches = details.get("matches", []) if _current.upstream == "recorded" else []
+        return SimpleNamespace(matches=[
+            SimpleNamespace(id=match["id"], score=match["score"], metadata=match["metadata"])
+            for match in matches
+        ])
+
+
+class PinnedRandom:
+    """Stand-in for app.py's random module that replays recorded verse choices.
+
+    Prompts without a scripture reference get a random verse; replaying the
+    recorded one keeps the Pinecone query and LLM prompt identical.
+    """
+
+    def __getattr__(self, name):
+        return getattr(random, name)
+
+    def choice(self, seq):
+        parse = _current.record.get("stages", {}).get("parse", {})
+        if parse.get("random_scripture"):
+            for item in seq:
+                if isinstance(item, dict) and item.get("reference") == parse.get("scripture_reference"):
+                    return item
+        return random.choice(seq)
+
+
+def replay_one(record, upstream, latency, scheduled):
+    """Send one captured prompt through the app and compare it with the capture.
+
+    Latency is measured from the request's scheduled arrival, so time spent
+    queued for a worker counts, as it would for a real client.
+    """
+    _current.record = record
+    _current.upstream = upstream
+    _current.latency = latency
+
+    response = devo_app.app.test_client().post("/generate", json={"prompt": record["prompt"]})
+    elapsed_ms = round((time.perf_counter() - scheduled) * 1000, 2)
+
+    return {
+        "id": record.get("id"),
+        "status": response.status_code,
+        "ms": elapsed_ms,
+        "original_ms": record.get("total_ms"),
+        "status_matches": response.status_code == record.get("status"),
+        "response_matches": response.get_json(silent=True) == record.get("response"),
+    }
+
+
+def replay(records, speed, upstream, latency, workers=None):
+    """Replay records on their original schedule divided by `speed`.
+
+    By default there is one worker per record; the pool only starts threads
+    as concurrency demands, so this doesn't cap the spike being reproduced.
+    """
+    devo_app.openai_client = StubOpenAI()
+    devo_app.pinecone_index = StubIndex()
+    devo_app.random = PinnedRandom()
+
+    origin = datetime.fromisoformat(records[0]["timestamp"])
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or len(records)) as executor:
+        futures = []
+        for record in records:
+            offset = (datetime.fromisoformat(record["timestamp"]) - origin).total_seconds()
+            scheduled = started + offset / speed if speed > 0 else started
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(replay_one, record, upstream, latency, scheduled))
+        return [future.result() for future in futures]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(results):
+    """Print latency percentiles and how many replies matched the captures"""
+    latencies = [result["ms"] for result in results]
+    original = [result["original_ms"] for result in results if result["original_ms"] is not None]
+    print(f"Replayed {len(results)} requests")
+    for label, values in (("replay", latencies), ("original", original)):
+        if values:
+            print(f"  {label:>8}: mean {statistics.mean(values):.1f} ms, "
+                  f"p50 {percentile(values, 50):.1f} ms, p95 {percentile(values, 95):.1f} ms, "
+                  f"max {max(values):.1f} ms")
+    print(f"  status matches:   {sum(result['status_matches'] for result in results)}/{len(results)}")
+    print(f"  response matches: {sum(result['response_matches'] for result in results)}/{len(results)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured /generate traffic against app.py")
+    parser.add_argument("captures", nargs="+", help="Capture JSONL files or glob patterns")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Arrival-rate multiplier (2 = twice as fast, 0 = send everything at once)")
+    parser.add_argument("--upstream", choices=["recorded", "stub"], default="recorded",
+                        help="Serve recorded upstream responses or canned stub responses")
+    parser.add_argument("--no-latency", action="store_true",
+                        help="Don't sleep for recorded upstream latencies")
+    parser.add_argument("--workers", type=int,
+                        help="Maximum concurrent requests (default: unbounded, one per capture)")
+    parser.add_argument("--out", help="Write per-request results to this JSONL file")
+    args = parser.parse_args()
+
+    records = load_captures(args.captures)
+    if not records:
+        parser.error("no capture records found")
+
+    results = replay(records, args.speed, args.upstream, not args.no_latency, args.workers)
+    summarize(results)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()